@@ -1,12 +1,14 @@
-import json
+import atexit
 import logging
-import csv
-from dataclasses import dataclass, field
-from typing import List, Optional, Tuple, Dict
-from inspect import signature
+import os
+import sys
+from array import array
+from dataclasses import dataclass, field, fields
+from functools import cache
+from typing import List, Optional, Tuple, Dict, Iterator, Iterable, FrozenSet, TextIO, Set
 from enum import Enum
 
-
+import ijson
 from voluptuous import (
     Schema,
     Invalid,
@@ -17,12 +19,24 @@ from voluptuous import (
     Length,
     ALLOW_EXTRA,
 )
-from geopandas import GeoDataFrame
-from shapely.geometry import Point
+import numpy as np
+import pandas as pd
+from geopandas import GeoDataFrame, points_from_xy
+
+try:
+    import osmium
+except ImportError:
+    # optional, only needed for reading .pbf files
+    osmium = None
 
 
 log = logging.getLogger()
 
+# Buffer sizes for the files read/written here, bigger than the default 8 KiB
+# to save on syscalls; the read one can be lowered on memory constrained machines.
+READ_BUFFER_SIZE = int(os.environ.get("GTFS_TO_OSM_READ_BUFFER_SIZE", 1 << 20))
+WRITE_BUFFER_SIZE = 1 << 16
+
 
 class ElemType(Enum):
     NODE = "node"
@@ -32,6 +46,10 @@ class ElemType(Enum):
 
 non_empty_string = All(str, Length(min=1))
 
+# (key, value) tags which make a node a stop; at least one of them is needed.
+# Used both by the validator below and by _is_stop_node().
+STOP_NODE_TAGS = frozenset({("public_transport", "platform"), ("highway", "bus_stop")})
+
 
 # Validates regular "bus stop" nodes
 osm_node_stop_validator = Schema(
@@ -46,8 +64,7 @@ osm_node_stop_validator = Schema(
              Schema(
                  Required(
                     Any(
-                        Schema({"public_transport": "platform"}, extra=ALLOW_EXTRA),
-                        Schema({"highway": "bus_stop"}, extra=ALLOW_EXTRA),
+                        *(Schema({k: v}, extra=ALLOW_EXTRA) for k, v in STOP_NODE_TAGS)
                     )
                 ), 
                 extra=ALLOW_EXTRA
@@ -80,6 +97,9 @@ osm_node_part_of_way_validator = Schema(
     required=True,
 )
 
+# how many elements are cross-checked with the validators above in debug mode
+SANITY_CHECK_SIZE = 100
+
 validators = {
     ElemType.NODE: osm_node_stop_validator,
     ElemType.WAY: osm_way_stop_validator,
@@ -93,120 +113,307 @@ def _is_elem_type(elem_type: ElemType, elem: dict, quiet: bool = False) -> bool:
     try:
         validators[elem_type](elem)
         return True
-    except Exception as e:
+    except Invalid as e:
         if not quiet:
             log.error(f"failed to validate element type '{elem_type}', data {elem}: {e}")
         return False
 
 
-def osm_2_gdf(path: str) -> GeoDataFrame:
-    """Creates a GeoDataFrame out of the JSON data exported by
-    Overpass."""
-
-    with open(path) as f:
-        raw_data = json.load(f)
-
-    types: List[str] = []
-    points: List[Point] = []
-    ids: List[str] = []
-    names: List[str] = []
-
-    platforms: List[dict] = []
-    platform_nodes: Dict[str, dict] = {}
-
-    for elem in raw_data["elements"]:
-        # Data should contain:
-        # 1) regular nodes (type: node, id, lat, lon, tags.name, tags.public_transport=platform)
-        # 2) platforms (type: way, id, nodes, tags.name, tags.public_transport=platform)
-        # 3) platform nodes (type: node, only id, lat and lon)
-
-        # A regular node - can be standalone or part of a way. Standalone nodes have tags,
-        # way nodes usually don't, so try to validate the data as a standalone node first.
-        if elem["type"] == ElemType.NODE.value:
-
-            if _is_elem_type(ElemType.NODE, elem, quiet=True):
-                types.append(elem["type"])
-                ids.append(str(elem["id"]))
-                points.append(Point(elem["lon"], elem["lat"]))
-                names.append(elem.get("tags", {}).get("name", "n/a"))
-                continue
+def _is_stop_node(tags: dict) -> bool:
+    """Inlined version of the tag checks done by `osm_node_stop_validator`."""
+    name = tags.get("name")
+    if name is not None and not (isinstance(name, str) and name):
+        return False
+    for key, value in STOP_NODE_TAGS:
+        if tags.get(key) == value:
+            return True
+    return False
+
+
+def _classify(elem: dict, quiet: bool = False) -> Optional[ElemType]:
+    """Returns the type of the OSM `elem`, or None if it should be skipped.
+
+    This does the same checks as the voluptuous validators, which are way too
+    slow to run on every element of a big export."""
+
+    # Data should contain:
+    # 1) regular nodes (type: node, id, lat, lon, tags.name, tags.public_transport=platform)
+    # 2) platforms (type: way, id, nodes, tags.name, tags.public_transport=platform)
+    # 3) platform nodes (type: node, only id, lat and lon)
+
+    # cheap check first, anything without a type and an id is of no use
+    if not isinstance(elem, dict) or "type" not in elem or "id" not in elem:
+        if not quiet:
+            log.error(f"invalid element, data {elem}")
+        return None
+
+    elem_type = elem["type"]
+    tags = elem.get("tags") or {}
+
+    # A regular node - can be standalone or part of a way. Standalone nodes have tags,
+    # way nodes usually don't, so try to match the data as a standalone node first.
+    if elem_type == "node":
+        if not (
+            isinstance(elem.get("id"), int)
+            and isinstance(elem.get("lat"), float)
+            and isinstance(elem.get("lon"), float)
+        ):
+            if not quiet:
+                log.error(f"invalid node, data {elem}")
+            return None
+
+        if _is_stop_node(tags):
+            return ElemType.NODE
+
+        if len(elem) != 4:
+            # like osm_node_part_of_way_validator, accept only type, id, lat
+            # and lon; anything else (tags, out meta attributes) is unexpected
+            if not quiet:
+                log.error(f"invalid stop or platform node, data {elem}")
+            return None
+
+        return ElemType.WAY_NODE
+
+    if elem_type == "way":
+        nodes = elem.get("nodes")
+        if (
+            isinstance(elem.get("id"), int)
+            and isinstance(nodes, list)
+            and len(nodes) >= 2
+            and all(isinstance(n, int) for n in nodes)
+            and tags.get("public_transport") == "platform"
+        ):
+            return ElemType.WAY
+
+        if not quiet:
+            log.error(f"invalid platform, data {elem}")
+
+    return None
 
-            if _is_elem_type(ElemType.WAY_NODE, elem):
-                platform_nodes[str(elem["id"])] = {
-                    # "type": "node",        # not needed
-                    # "id": str(elem["id"]),
-                    "point": Point(elem["lon"], elem["lat"]),
-                }
-                continue
 
-        elif elem["type"] == ElemType.WAY.value:
-
-            # platform (way)
-            if _is_elem_type(ElemType.WAY, elem):
-                # For platforms, we'll represent on the map only the first node
-                # But the coordinates of the node to draw will be known after the
-                # whole data file has been parsed. So, in the mean while, save the
-                # data
-                platforms.append(
-                    {
-                        "type": "way",
-                        "id": str(elem["id"]),
-                        "name": elem.get("tags", {}).get("name", "n/a"),
-                        "nodes": elem["nodes"],
-                    }
+def _sanity_check(elem: dict):
+    """Cross-checks `_classify` against the voluptuous validators; only meant
+    to be used while debugging."""
+    # quiet, the errors are logged when the element is parsed anyway
+    elem_type = _classify(elem, quiet=True)
+    matches = [t for t in ElemType if _is_elem_type(t, elem, quiet=True)]
+    if elem_type is not None and elem_type not in matches:
+        log.warning(f"element classified as {elem_type}, but matches {matches}: {elem}")
+
+
+def _iter_elements(path: str) -> Iterator[dict]:
+    """Streams the elements of the JSON data exported by Overpass one by one,
+    without loading the whole file in memory."""
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        # use_float, otherwise ijson returns Decimal for lat/lon
+        yield from ijson.items(f, "elements.item", use_float=True)
+
+
+@dataclass
+class _StopColumns:
+    """Column-wise (rather than row-wise) storage of the stops found in the OSM
+    data. Ids and coordinates are kept in typed arrays, which are handed over
+    to numpy without copying them."""
+
+    types: List[str] = field(default_factory=list)
+    ids: array = field(default_factory=lambda: array("q"))
+    lons: array = field(default_factory=lambda: array("d"))
+    lats: array = field(default_factory=lambda: array("d"))
+    names: List[str] = field(default_factory=list)
+
+    def append(self, stop_type: str, stop_id: int, lon: float, lat: float, name: str):
+        self.types.append(stop_type)
+        self.ids.append(stop_id)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        # lots of stops share the same name, keep only one copy of each
+        self.names.append(sys.intern(name))
+
+    def to_gdf(self) -> GeoDataFrame:
+        return GeoDataFrame(
+            {
+                "stop_type": self.types,
+                "stop_id": np.frombuffer(self.ids, dtype=np.int64),
+                "stop_name": self.names,
+            },
+            # build all the points at once, it's way faster than one by one
+            geometry=points_from_xy(
+                np.frombuffer(self.lons), np.frombuffer(self.lats), crs="EPSG:4326"
+            ),
+            crs="EPSG:4326",
+        )
+
+
+def _osm_pbf_2_gdf(path: str) -> GeoDataFrame:
+    """Creates a GeoDataFrame out of an OSM PBF extract, using osmium."""
+    if osmium is None:
+        raise RuntimeError(f"can't read {path}, the osmium package is not installed")
+
+    stops = _StopColumns()
+
+    class StopsHandler(osmium.SimpleHandler):
+        def node(self, n):
+            if _is_stop_node(n.tags) and n.location.valid():
+                stops.append(
+                    "node", n.id, n.location.lon, n.location.lat, n.tags.get("name", "n/a")
                 )
-                continue
 
+        def way(self, w):
+            if w.tags.get("public_transport") != "platform" or len(w.nodes) < 2:
+                return
+
+            # same as for the JSON data, represent platforms by their first node
+            location = next((n.location for n in w.nodes if n.location.valid()), None)
+            if location is None:
+                log.error(f"failed to find a node for platform {w.id}")
+                return
+
+            stops.append("way", w.id, location.lon, location.lat, w.tags.get("name", "n/a"))
+
+    # locations=True makes osmium resolve the coordinates of the way nodes
+    StopsHandler().apply_file(path, locations=True)
+
+    return stops.to_gdf()
+
+
+@dataclass
+class _OsmData:
+    """The data collected while going through the elements of the JSON data
+    exported by Overpass."""
+
+    stops: _StopColumns = field(default_factory=_StopColumns)
+    platforms: List[dict] = field(default_factory=list)
+    # ids of the nodes which are part of the platforms seen so far
+    wanted_nodes: Set[int] = field(default_factory=set)
+    # node id -> (lon, lat), only for the wanted nodes
+    platform_nodes: Dict[int, Tuple[float, float]] = field(default_factory=dict)
+
+    def add(self, elem: dict):
+        elem_type = _classify(elem)
+
+        if elem_type is ElemType.NODE:
+            self.stops.append(
+                ElemType.NODE.value,
+                elem["id"],
+                elem["lon"],
+                elem["lat"],
+                elem["tags"].get("name", "n/a"),
+            )
+
+        elif elem_type is ElemType.WAY_NODE:
+            # Overpass outputs the nodes of the ways ("recurse down") after the
+            # ways themselves, so usually there's no need to keep any other node
+            # around; see osm_2_gdf() for when that's not the case
+            if elem["id"] in self.wanted_nodes:
+                self.platform_nodes[elem["id"]] = (elem["lon"], elem["lat"])
+
+        elif elem_type is ElemType.WAY:
+            # For platforms, we'll represent on the map only the first node
+            # But the coordinates of the node to draw will be known after the
+            # whole data file has been parsed. So, in the mean while, save the
+            # data
+            self.platforms.append(
+                {
+                    "type": ElemType.WAY.value,
+                    "id": elem["id"],
+                    "name": elem["tags"].get("name", "n/a"),
+                    "nodes": elem["nodes"],
+                }
+            )
+            self.wanted_nodes.update(elem["nodes"])
 
         # TODO: exclude elements which already have GTFS specific tags
 
-    log.info(f"resolving nodes of {len(platforms)} platforms")
+    def unresolved_nodes(self) -> Set[int]:
+        """Returns, for every platform, the nodes which come before the first
+        known one in the platform's node list (all of them if none is known).
+        They are missing when they came before the platform itself; once they
+        are picked up, platforms are placed at the same node as before."""
+        missing: Set[int] = set()
+        for platform in self.platforms:
+            for n in platform["nodes"]:
+                if n in self.platform_nodes:
+                    break
+                missing.add(n)
+        return missing
 
-    try:
-        for platform in platforms:
+    def resolve_platforms(self):
+        """Adds the platforms to the stops, now that their nodes are known."""
+        log.info(f"resolving nodes of {len(self.platforms)} platforms")
+
+        for platform in self.platforms:
             # get the first node of the way which has the needed data
-            for node in platform["nodes"]:
-                try:
-                    n = platform_nodes[str(node)]
-                except KeyError as e:
-                    log.error(f"platform node {node} not found in data")
-                    continue
-                else:
-                    types.append(platform["type"])
-                    ids.append(platform["id"])
-                    points.append(n["point"])
-                    names.append(platform["name"])
-                    break
-            else:
+            node = next((n for n in platform["nodes"] if n in self.platform_nodes), None)
+            if node is None:
                 log.error(f"failed to find a node for platform {platform}")
-    except Exception as e:
-        log.exception(f"fooock: {e}")
-
-    return GeoDataFrame(
-        {
-            "stop_type": types,
-            "stop_id": ids,
-            "stop_name": names,
-        },
-        geometry=points,
-        crs="EPSG:4326",
-    )
+                continue
+
+            lon, lat = self.platform_nodes[node]
+            self.stops.append(platform["type"], platform["id"], lon, lat, platform["name"])
+
+
+def _sanity_checked(elements: Iterator[dict]) -> Iterator[dict]:
+    """Passes `elements` through, cross-checking the first few against the
+    voluptuous validators."""
+    for i, elem in enumerate(elements):
+        if i < SANITY_CHECK_SIZE:
+            _sanity_check(elem)
+        yield elem
+
+
+def osm_2_gdf(path: str) -> GeoDataFrame:
+    """Creates a GeoDataFrame out of the JSON data exported by
+    Overpass, or out of an OSM PBF extract if `path` is a .pbf file."""
+
+    if path.endswith(".pbf"):
+        return _osm_pbf_2_gdf(path)
+
+    elements = _iter_elements(path)
+    if log.isEnabledFor(logging.DEBUG):
+        elements = _sanity_checked(elements)
+
+    data = _OsmData()
+    for elem in elements:
+        data.add(elem)
+
+    # Only the nodes of the platforms seen so far are kept while parsing, which
+    # works for Overpass' "recurse down" ordering. If some nodes came before
+    # their platform, go through the data again and pick up just those.
+    missing = data.unresolved_nodes()
+    if missing:
+        log.info(f"looking for {len(missing)} platform nodes in a second pass")
+        for elem in _iter_elements(path):
+            if elem.get("id") in missing and _classify(elem) is ElemType.WAY_NODE:
+                data.platform_nodes[elem["id"]] = (elem["lon"], elem["lat"])
+                missing.discard(elem["id"])
+                # when the nodes come first, there's no need to read the rest
+                if not missing:
+                    break
+
+    data.resolve_platforms()
+
+    return data.stops.to_gdf()
 
 
 def filter_correlated_data(
     correlation_file: str, gtfs_nodes: GeoDataFrame, osm_nodes: GeoDataFrame
 ) -> Tuple[GeoDataFrame, GeoDataFrame]:
-    gtfs_correlated_nodes = set()
-    osm_correlated_nodes = set()
-
-    with open(correlation_file) as f:
-        reader = csv.reader(f)
-
-        for row in reader:
-            # row[0] - gtfs id
-            # row[2] - osm id
-            gtfs_correlated_nodes.add(row[0])
-            osm_correlated_nodes.add(row[2])
+    try:
+        with open(correlation_file, buffering=READ_BUFFER_SIZE) as f:
+            # row format: gtfs id, gtfs name, osm type, osm id, osm name
+            correlated = pd.read_csv(
+                f,
+                header=None,
+                usecols=[0, 3],
+                # GTFS ids can be anything, OSM ones are always numbers
+                dtype={0: str, 3: np.int64},
+                engine="c",
+            )
+    except pd.errors.EmptyDataError:
+        return gtfs_nodes, osm_nodes
+
+    gtfs_correlated_nodes = pd.Index(correlated[0].unique())
+    osm_correlated_nodes = pd.Index(correlated[3].unique())
 
     return (
         gtfs_nodes[~gtfs_nodes["stop_id"].isin(gtfs_correlated_nodes)],
@@ -214,7 +421,50 @@ def filter_correlated_data(
     )
 
 
-def write_correlation_row(state: "State", file: str):
+def _csv_escape(value: str) -> str:
+    """Quotes `value` for CSV, the same way csv.writer does (minimal quoting)."""
+    if '"' in value or "," in value or "\n" in value or "\r" in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _csv_line(row: list) -> str:
+    # written by hand, the rows are too simple to need csv.writer
+    # (None is written as an empty field, like csv.writer does)
+    return ",".join(_csv_escape("" if x is None else str(x)) for x in row) + "\r\n"
+
+
+def _correlation_file(state: "State", file: str) -> TextIO:
+    """Returns the correlation `file`, opening it the first time it's needed.
+    The file is then kept open (and is closed on exit), rather than being
+    reopened for every row."""
+    if state.correlation_file is None or state.correlation_file.name != file:
+        state.close()
+        state.correlation_file = open(file, "a", newline="", buffering=WRITE_BUFFER_SIZE)
+        # register the state (not the file) so that it's done only once per state
+        atexit.unregister(state.close)
+        atexit.register(state.close)
+    return state.correlation_file
+
+
+def write_correlation_rows(state: "State", rows: Iterable[list], file: str):
+    """Appends `rows` to the correlation `file` in one go, e.g. when importing
+    correlations made elsewhere. The rows are written through the file kept
+    open on `state`, so they always end up after the rows written before."""
+    lines = [_csv_line(row) for row in rows]
+    f = _correlation_file(state, file)
+    f.writelines(lines)
+    state.rows_written += len(lines)
+    f.flush()
+
+
+def write_correlation_row(
+    state: "State", file: str, flush_every: int = 1, fsync_every: int = 0
+):
+    """Appends the currently selected GTFS/OSM pair to the correlation `file`.
+
+    The file is flushed every `flush_every` rows (0 leaves it to the buffering)
+    and, if `fsync_every` is set, also fsync'ed to disk every `fsync_every` rows."""
     row = [
         state.last_clicked_gtfs_element.stop_id,
         state.last_clicked_gtfs_element.stop_name,
@@ -223,19 +473,32 @@ def write_correlation_row(state: "State", file: str):
         state.last_clicked_osm_element.stop_name,
     ]
     log.info(f"writing correlation row {row}")
-    with open(file, "a", newline="") as f:
-        w = csv.writer(f)
 
-        # row format: gtfs id, gtfs name, osm id, osm name
-        w.writerow(row)
+    # row format: gtfs id, gtfs name, osm type, osm id, osm name
+    f = _correlation_file(state, file)
+    f.write(_csv_line(row))
+    state.rows_written += 1
+
+    if flush_every and state.rows_written % flush_every == 0:
+        f.flush()
+
+    if fsync_every and state.rows_written % fsync_every == 0:
         f.flush()
+        os.fsync(f.fileno())
 
 
 # Some classes to encapsulate specific data; not really needed, but makes working
 # with the data easier.
 
 
-@dataclass
+@cache
+def _known_fields(cls) -> FrozenSet[str]:
+    """Returns the names of the fields of dataclass `cls`; computed only once
+    per class."""
+    return frozenset(f.name for f in fields(cls))
+
+
+@dataclass(slots=True, frozen=True)
 class GtfsStop:
     """GtfsStop contains relevant data about a GTFS bus/tram/etc. stop"""
 
@@ -247,35 +510,44 @@ class GtfsStop:
 
     @classmethod
     def from_kwargs(cls, **kwargs):
-        known_fields = {field for field in signature(cls).parameters}
+        known_fields = _known_fields(cls)
         # use the native ones to create the class ...
         return cls(**{k: v for k, v in kwargs.items() if k in known_fields})
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class OsmStop:
     """OsmStop contains relevant data about an OSM bus/tram/etc. stop"""
 
     stop_type: str 
-    stop_id: field(default_factory=str)  # id is int, but make it string
+    stop_id: int
     stop_name: str
 
     @classmethod
     def from_kwargs(cls, **kwargs):
-        known_fields = {field for field in signature(cls).parameters}
+        known_fields = _known_fields(cls)
         # use the native ones to create the class ...
         return cls(**{k: v for k, v in kwargs.items() if k in known_fields})
 
 
-@dataclass
+@dataclass(slots=True)
 class State:
     last_clicked_gtfs_element: Optional[GtfsStop] = None
     last_clicked_osm_element: Optional[OsmStop] = None
+    # number of rows written to the correlation file
+    rows_written: int = 0
+    # the correlation file is kept open between writes, see write_correlation_row()
+    correlation_file: Optional[TextIO] = field(default=None, repr=False, compare=False)
 
     def reset(self):
         self.last_clicked_gtfs_element = None
         self.last_clicked_osm_element = None
 
+    def close(self):
+        if self.correlation_file is not None:
+            self.correlation_file.close()
+            self.correlation_file = None
+
     def both_nodes_set(self) -> bool:
         return (
             self.last_clicked_gtfs_element is not None